@@ -0,0 +1,3 @@
+from mbutil.cli import main
+
+main()
@@ -7,14 +7,37 @@
 # (c) 2016 ePi Rational, Inc.
 # Licensed under BSD
 
+import argparse
+import functools
 import logging
 import os
+import stat
 import sys
-from optparse import OptionParser
-
-from mbutil.util import mbtiles_to_disk, disk_to_mbtiles, mbtiles_metadata_to_disk, mbtiles_to_s3
+from concurrent.futures import ThreadPoolExecutor
+
+_aws_logging_quieted = False
+
+def configure_logging(verbose=False, silent=False):
+    """Set up logging the way the mb-util command does.
+
+    The root logger only gets a handler if it has none yet (see
+    logging.basicConfig), so an application's own configuration is kept;
+    the mbutil logger level always follows verbose/silent.
+    """
+    if silent:
+        level = logging.ERROR
+    elif verbose:
+        level = logging.DEBUG
+    else:
+        level = logging.INFO
+    logging.basicConfig(level=level, format='%(message)s')
+    logging.getLogger('mbutil').setLevel(level)
 
 def quiet_aws_logging(level=logging.WARNING):
+    global _aws_logging_quieted
+    if _aws_logging_quieted:
+        return
+    _aws_logging_quieted = True
     for name in ("boto3", "botocore", "s3transfer", "urllib3"):
         lg = logging.getLogger(name)
         lg.setLevel(level)
@@ -22,12 +45,95 @@ def quiet_aws_logging(level=logging.WARNING):
         if not lg.handlers:
             lg.addHandler(logging.NullHandler())
 
-def main():
-
-    logging.basicConfig(level=logging.DEBUG)
+def _mbtiles_to_s3(mbtiles_file, s3_path, options, executor):
+    from mbutil.util import mbtiles_to_s3
     quiet_aws_logging(logging.WARNING)
-
-    parser = OptionParser(usage="""usage: %prog [options] input output
+    mbtiles_to_s3(mbtiles_file, s3_path,
+        prefix=options.prefix,
+        scheme=options.scheme,
+        format=options.format,
+        callback=options.callback,
+        cache_control=options.cache_control,
+        content_type_override=options.content_type_override,
+        content_encoding=options.content_encoding,
+        max_pool_connections=options.max_pool_connections,
+        max_workers=options.max_workers,
+        inflight_factor=options.inflight_factor,
+        sqlite_batch=options.sqlite_batch,
+        silent=options.silent,
+        executor=executor)
+
+def _mbtiles_metadata_to_disk(mbtiles_file, dumps, options, executor):
+    from mbutil.util import mbtiles_metadata_to_disk
+    mbtiles_metadata_to_disk(mbtiles_file, silent=options.silent)
+
+def _mbtiles_to_disk(mbtiles_file, directory_path, options, executor):
+    from mbutil.util import mbtiles_to_disk
+    mbtiles_to_disk(mbtiles_file, directory_path,
+        scheme=options.scheme,
+        format=options.format,
+        callback=options.callback,
+        metadata_only=options.metadata_only,
+        max_workers=options.max_workers,
+        silent=options.silent,
+        executor=executor)
+
+def _disk_to_mbtiles(directory_path, mbtiles_file, options, executor):
+    from mbutil.util import disk_to_mbtiles
+    disk_to_mbtiles(directory_path, mbtiles_file,
+        scheme=options.scheme,
+        format=options.format,
+        compression=options.compression,
+        vacuum=options.vacuum,
+        sqlite_batch=options.sqlite_batch,
+        max_workers=options.max_workers,
+        silent=options.silent,
+        executor=executor)
+
+_SCHEMES = ('wms', 'tms', 'xyz', 'zyx', 'gwc', 'ags')
+_IMAGE_FORMATS = ('png', 'jpg', 'pbf', 'webp', 'mvt')
+
+def _positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError('%r is not a positive integer' % value)
+    return number
+
+def _classify(path):
+    """Return 'file', 'dir', 'other' or 'missing' for path using a single
+    stat(). Paths that cannot be stat()ed at all (permissions, overlong or
+    NUL-containing names) count as missing, as os.path.exists() would."""
+    try:
+        mode = os.stat(path).st_mode
+    except (OSError, ValueError):
+        return 'missing'
+    if stat.S_ISREG(mode):
+        return 'file'
+    if stat.S_ISDIR(mode):
+        return 'dir'
+    return 'other'
+
+_DST_KINDS = {'dumps': 'dumps'}
+
+# (input kind, output kind) -> handler
+_HANDLERS = {
+    ('file', 's3'): _mbtiles_to_s3,
+    ('file', 'dumps'): _mbtiles_metadata_to_disk,
+    ('file', 'missing'): _mbtiles_to_disk,
+    ('dir', 'missing'): _disk_to_mbtiles,
+}
+
+_ERRORS = {
+    ('file', 'file'): 'To export MBTiles to disk, specify a directory that does not yet exist\n',
+    ('file', 'dir'): 'To export MBTiles to disk, specify a directory that does not yet exist\n',
+    ('file', 'other'): 'To export MBTiles to disk, specify a directory that does not yet exist\n',
+    ('dir', 'file'): 'Importing tiles into already-existing MBTiles is not yet supported\n',
+}
+
+_USAGE = """%(prog)s [options] input output
 
     Examples:
 
@@ -37,109 +143,170 @@ def main():
     Export an mbtiles file to a directory of files:
     $ mb-util world.mbtiles tiles # tiles must not already exist
 
+    Export only metadata.json (and layer.json) of an mbtiles file to a directory:
+    $ mb-util world.mbtiles tiles --metadata_only
+
     Export an mbtiles file to an S3 bucket:
     $ mb-util world.mbtiles s3://mybucket --prefix=mytiles
 
     Import a directory of tiles into an mbtiles file:
-    $ mb-util tiles world.mbtiles # mbtiles file must not already exist""")
-
-    parser.add_option('--scheme', dest='scheme',
-        help='''Tiling scheme of the tiles. Default is "xyz" (z/x/y), other options '''
-        + '''are "tms" which is also z/x/y but uses a flipped y coordinate, and "wms" '''
-        + '''which replicates the MapServer WMS TileCache directory structure '''
-        + '''"z/000/000/x/000/000/y.png"''',
-        type='choice',
-        choices=['wms', 'tms', 'xyz', 'zyx', 'gwc','ags'],
+    $ mb-util tiles world.mbtiles # mbtiles file must not already exist"""
+
+_HELP = {
+    'scheme': '''Tiling scheme of the tiles. Default is "xyz" (z/x/y), other options '''
+        '''are "tms" which is also z/x/y but uses a flipped y coordinate, and "wms" '''
+        '''which replicates the MapServer WMS TileCache directory structure '''
+        '''"z/000/000/x/000/000/y.png"''',
+    'format': '''The format of the image tiles, either png, jpg, webp, pbf or mvt''',
+    'callback': '''Option to control JSONP callback for UTFGrid tiles. If grids are not '''
+        '''used as JSONP, you can remove callbacks specifying --grid_callback="" ''',
+    'compression': '''Do mbtiles compression''',
+    'vacuum': '''When importing, VACUUM the new mbtiles file (default: only with --do_compression)''',
+    'metadata_only': '''When exporting to disk, only write metadata.json (and layer.json) and skip tiles and grids''',
+    'silent': '''Dictate whether the operations should run silently''',
+    'verbose': '''Log debug messages, including one line per tile''',
+    'cache_control': '''Optional Cache-Control header value (e.g., 'max-age=31536000, immutable')''',
+    'content_type_override': '''Optional explicit Content-Type for tile images''',
+    'content_encoding': '''Optional Content-Encoding for tile images (e.g., 'gzip')''',
+    'prefix': '''Optional prefix to add to the start of each S3 object key''',
+    'max_workers': '''Optional number of maximum workers to use for parallel processing (default: 8). '''
+        '''S3 uploads are network bound and usually benefit from much higher values (e.g. 128)''',
+    'max_pool_connections': '''Optional number of maximum connections to use for S3 client (default: 64, at least max_workers)''',
+    'inflight_factor': '''Optional factor to multiply max_workers by to determine number of in-flight S3 requests (default: 8)''',
+    'sqlite_batch': '''Optional number of operations to batch into a single transaction when writing to mbtiles (default: 1000)''',
+}
+
+@functools.lru_cache(maxsize=1)
+def _build_parser():
+    parser = argparse.ArgumentParser(prog='mb-util', usage=_USAGE)
+
+    parser.add_argument('--scheme', dest='scheme',
+        help=_HELP['scheme'],
+        choices=_SCHEMES,
         default='xyz')
 
-    parser.add_option('--image_format', dest='format',
-        help='''The format of the image tiles, either png, jpg, webp, pbf or mvt''',
-        choices=['png', 'jpg', 'pbf', 'webp', 'mvt'],
+    parser.add_argument('--image_format', dest='format',
+        help=_HELP['format'],
+        choices=_IMAGE_FORMATS,
         default='png')
 
-    parser.add_option('--grid_callback', dest='callback',
-        help='''Option to control JSONP callback for UTFGrid tiles. If grids are not '''
-        + '''used as JSONP, you can remove callbacks specifying --grid_callback="" ''',
+    parser.add_argument('--grid_callback', dest='callback',
+        help=_HELP['callback'],
         default='grid')
 
-    parser.add_option('--do_compression', dest='compression',
-        help='''Do mbtiles compression''',
+    parser.add_argument('--do_compression', dest='compression',
+        help=_HELP['compression'],
+        action="store_true",
+        default=False)
+
+    parser.add_argument('--vacuum', dest='vacuum',
+        help=_HELP['vacuum'],
+        action="store_true",
+        default=None)
+
+    parser.add_argument('--metadata_only', dest='metadata_only',
+        help=_HELP['metadata_only'],
         action="store_true",
         default=False)
 
-    parser.add_option('--silent', dest='silent',
-        help='''Dictate whether the operations should run silently''',
+    parser.add_argument('--silent', dest='silent',
+        help=_HELP['silent'],
         action="store_true",
         default=False)
 
-    parser.add_option('--cache_control', dest='cache_control',
-        help='''Optional Cache-Control header value (e.g., 'max-age=31536000, immutable')''',
+    parser.add_argument('--verbose', dest='verbose',
+        help=_HELP['verbose'],
+        action="store_true",
+        default=False)
+
+    parser.add_argument('--cache_control', dest='cache_control',
+        help=_HELP['cache_control'],
         default=None)
 
-    parser.add_option('--content_type', dest='content_type_override',
-        help='''Optional explicit Content-Type for tile images''',
+    parser.add_argument('--content_type', dest='content_type_override',
+        help=_HELP['content_type_override'],
         default=None)
 
-    parser.add_option('--content_encoding', dest='content_encoding',
-        help='''Optional Content-Encoding for tile images (e.g., 'gzip')''',
+    parser.add_argument('--content_encoding', dest='content_encoding',
+        help=_HELP['content_encoding'],
         default=None)
 
-    parser.add_option('--prefix', dest='prefix',
-        help='''Optional prefix to add to the start of each S3 object key''',
+    parser.add_argument('--prefix', dest='prefix',
+        help=_HELP['prefix'],
         default='')
 
-    parser.add_option('--max_workers', dest='max_workers',
-        help='''Optional number of maximum workers to use for parallel processing (default: 8)''',
-        type=int,
+    parser.add_argument('--max_workers', dest='max_workers',
+        help=_HELP['max_workers'],
+        type=_positive_int,
         default=8)
 
-    parser.add_option('--max_pool_connections', dest='max_pool_connections',
-        help='''Optional number of maximum connections to use for S3 client (default: 64)''',
-        type=int,
+    parser.add_argument('--max_pool_connections', dest='max_pool_connections',
+        help=_HELP['max_pool_connections'],
+        type=_positive_int,
         default=64)
 
-    parser.add_option('--inflight_factor', dest='inflight_factor',
-        help='''Optional factor to multiply max_workers by to determine number of in-flight S3 requests (default: 8)''',
-        type=int,
+    parser.add_argument('--inflight_factor', dest='inflight_factor',
+        help=_HELP['inflight_factor'],
+        type=_positive_int,
         default=8)
 
-    parser.add_option('--sqlite_batch', dest='sqlite_batch',
-        help='''Optional number of operations to batch into a single transaction when writing to mbtiles (default: 1000)''',
-        type=int,
+    parser.add_argument('--sqlite_batch', dest='sqlite_batch',
+        help=_HELP['sqlite_batch'],
+        type=_positive_int,
         default=1000)
 
-    (options, args) = parser.parse_args()
+    parser.add_argument('args', nargs='*', help=argparse.SUPPRESS)
+
+    return parser
+
+def main(argv=None):
+
+    if argv is None:
+        argv = sys.argv[1:]
+
+    parser = _build_parser()
+
+    # An input and an output are always required, so fewer than two
+    # arguments can only mean help; answer before doing anything else.
+    if len(argv) < 2:
+        parser.print_help()
+        sys.exit(0 if ('-h' in argv or '--help' in argv) else 1)
+
+    options = parser.parse_intermixed_args(argv)
+    args = options.args
+    del options.args
 
     # Transfer operations
     if len(args) != 2:
         parser.print_help()
         sys.exit(1)
 
-    if os.path.isfile(args[0]) and os.path.exists(args[1]):
-        sys.stderr.write('To export MBTiles to disk, specify a directory that does not yet exist\n')
+    src, dst = args
+    src_kind = _classify(src)
+    if src_kind == 'missing':
+        sys.stderr.write('Input %s does not exist\n' % src)
         sys.exit(1)
 
-    # to s3
-    if os.path.isfile(args[0]) and args[1].startswith("s3://"):
-        mbtiles_file, s3_path = args
-        mbtiles_to_s3(mbtiles_file, s3_path, **options.__dict__)
-        sys.exit(0)
+    # Outputs that aren't filesystem paths are recognised without a stat()
+    dst_kind = _DST_KINDS.get(dst) or ('s3' if dst.startswith('s3://') else None)
+    if dst_kind is None:
+        dst_kind = _classify(dst)
 
-    # to disk
-    if os.path.isfile(args[0]) and args[1]=="dumps":
-        mbtiles_file, dumps = args
-        mbtiles_metadata_to_disk(mbtiles_file, **options.__dict__)
+    error = _ERRORS.get((src_kind, dst_kind))
+    if error:
+        sys.stderr.write(error)
         sys.exit(1)
 
-    if os.path.isfile(args[0]) and not os.path.exists(args[1]):
-        mbtiles_file, directory_path = args
-        mbtiles_to_disk(mbtiles_file, directory_path, **options.__dict__)
-
-    if os.path.isdir(args[0]) and os.path.isfile(args[1]):
-        sys.stderr.write('Importing tiles into already-existing MBTiles is not yet supported\n')
+    handler = _HANDLERS.get((src_kind, dst_kind))
+    if handler is None:
+        parser.print_help()
         sys.exit(1)
 
-    # to mbtiles
-    if os.path.isdir(args[0]) and not os.path.isfile(args[0]):
-        directory_path, mbtiles_file = args
-        disk_to_mbtiles(directory_path, mbtiles_file, **options.__dict__)
+    configure_logging(verbose=options.verbose, silent=options.silent)
+
+    # One worker pool for the whole invocation; threads are only started
+    # once a handler actually submits work to it.
+    with ThreadPoolExecutor(max_workers=options.max_workers,
+                            thread_name_prefix='mbutil') as executor:
+        handler(src, dst, options, executor)
+    sys.exit(0)
@@ -17,23 +17,44 @@ import os
 import json
 import zlib
 import re
+import hashlib
+import collections
+import itertools
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 try:
-    import boto3
-    from botocore.exceptions import BotoCoreError, ClientError
-    from botocore.config import Config
-except Exception:  # defer import errors until the function is actually used
-    boto3 = None
-    BotoCoreError = Exception
-    ClientError = Exception
-    Config = None
+    import orjson
+except ImportError:
+    orjson = None
 
 logger = logging.getLogger(__name__)
 
+# JSONP wrapper around an imported UTFGrid, e.g. grid({...});
+_CALLBACK_RE = re.compile(rb'[\w\s=+-/]+\((\{.*\})\);?', re.DOTALL)
+
+# Grids and their grid_data are (de)serialized with orjson when it is
+# installed; both functions return/accept UTF-8 bytes either way.
+if orjson is not None:
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+else:
+    def _json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+    _json_loads = json.loads
+
 def flip_y(zoom, y):
     return (2**zoom-1) - y
 
+def wms_dirs(z, x, y):
+    """Return the MapServer WMS TileCache directories "zz/xxx/xxx/xxx/yyy/yyy"
+    of a tile, and the "yyy" stem of its file name."""
+    x_hi, x_rest = divmod(int(x), 1000000)
+    x_mid, x_lo = divmod(x_rest, 1000)
+    y_hi, y_rest = divmod(int(y), 1000000)
+    y_mid, y_lo = divmod(y_rest, 1000)
+    return ("%02d" % z, "%03d" % x_hi, "%03d" % x_mid, "%03d" % x_lo,
+            "%03d" % y_hi, "%03d" % y_mid), "%03d" % y_lo
+
 def mbtiles_setup(cur):
     cur.execute("""
         create table tiles (
@@ -67,6 +88,16 @@ def optimize_connection(cur):
     cur.execute("""PRAGMA locking_mode=EXCLUSIVE""")
     cur.execute("""PRAGMA journal_mode=DELETE""")
 
+def optimize_connection_for_bulk(cur):
+    # For freshly created output databases only: no rollback journal, no
+    # fsync, large page cache.
+    cur.execute("""PRAGMA synchronous=OFF""")
+    cur.execute("""PRAGMA locking_mode=EXCLUSIVE""")
+    cur.execute("""PRAGMA journal_mode=OFF""")
+    cur.execute("""PRAGMA temp_store=MEMORY""")
+    cur.execute("""PRAGMA cache_size=-262144""")
+    cur.execute("""PRAGMA mmap_size=1073741824""")
+
 def compression_prepare(cur, silent):
     if not silent:
         logger.debug('Prepare database compression.')
@@ -83,10 +114,12 @@ def compression_prepare(cur, silent):
         tile_id integer);
     """)
 
-def optimize_database(cur, silent):
+def optimize_database(cur, silent, vacuum=True):
     if not silent:
         logger.debug('analyzing db')
     cur.execute("""ANALYZE;""")
+    if not vacuum:
+        return
     if not silent:
         logger.debug('cleaning db')
 
@@ -97,62 +130,39 @@ def optimize_database(cur, silent):
     cur.isolation_level = ''  # reset default value of isolation_level
 
 
-def compression_do(cur, con, chunk, silent):
+def _tile_hash(tile_data):
+    if tile_data is None:
+        return None
+    return hashlib.sha1(tile_data).digest()
+
+def compression_do(cur, con, silent):
     if not silent:
         logger.debug('Making database compression.')
-    overlapping = 0
-    unique = 0
-    total = 0
-    cur.execute("select count(zoom_level) from tiles")
-    res = cur.fetchone()
-    total_tiles = res[0]
-    last_id = 0
-    if not silent:
-        logging.debug("%d total tiles to fetch" % total_tiles)
-    for i in range(total_tiles // chunk + 1):
-        if not silent:
-            logging.debug("%d / %d rounds done" % (i, (total_tiles / chunk)))
-        ids = []
-        files = []
-        start = time.time()
-        cur.execute("""select zoom_level, tile_column, tile_row, tile_data
-            from tiles where rowid > ? and rowid <= ?""", ((i * chunk), ((i + 1) * chunk)))
-        if not silent:
-            logger.debug("select: %s" % (time.time() - start))
-        rows = cur.fetchall()
-        for r in rows:
-            total = total + 1
-            if r[3] in files:
-                overlapping = overlapping + 1
-                start = time.time()
-                query = """insert into map
-                    (zoom_level, tile_column, tile_row, tile_id)
-                    values (?, ?, ?, ?)"""
-                if not silent:
-                    logger.debug("insert: %s" % (time.time() - start))
-                cur.execute(query, (r[0], r[1], r[2], ids[files.index(r[3])]))
-            else:
-                unique = unique + 1
-                last_id += 1
-
-                ids.append(last_id)
-                files.append(r[3])
-
-                start = time.time()
-                query = """insert into images
-                    (tile_id, tile_data)
-                    values (?, ?)"""
-                cur.execute(query, (str(last_id), sqlite3.Binary(r[3])))
-                if not silent:
-                    logger.debug("insert into images: %s" % (time.time() - start))
-                start = time.time()
-                query = """insert into map
-                    (zoom_level, tile_column, tile_row, tile_id)
-                    values (?, ?, ?, ?)"""
-                cur.execute(query, (r[0], r[1], r[2], last_id))
-                if not silent:
-                    logger.debug("insert into map: %s" % (time.time() - start))
-        con.commit()
+    # Tiles are bucketed by a digest of their bytes so SQLite mostly compares
+    # 20-byte keys, but two tiles only share an image when their bytes are
+    # equal too; a digest collision can never merge different tiles.
+    # Each distinct tile keeps the rowid of its first occurrence as tile_id.
+    con.create_function('mbutil_tile_hash', 1, _tile_hash)
+    cur.execute("""create temp table tile_hashes as
+        select rowid as tile_id, mbutil_tile_hash(tile_data) as tile_hash
+        from tiles""")
+    cur.execute("""create index tile_hashes_hash on tile_hashes
+        (tile_hash, tile_id)""")
+    cur.execute("""insert into images (tile_id, tile_data)
+        select tiles.rowid, tiles.tile_data from tiles
+        where tiles.rowid in
+            (select min(h.tile_id) from tile_hashes h
+                join tiles t on t.rowid = h.tile_id
+                group by h.tile_hash, t.tile_data)""")
+    cur.execute("""insert into map (zoom_level, tile_column, tile_row, tile_id)
+        select tiles.zoom_level, tiles.tile_column, tiles.tile_row,
+            (select min(first.tile_id) from tile_hashes first
+                join tiles first_tile on first_tile.rowid = first.tile_id
+                where first.tile_hash = h.tile_hash
+                and first_tile.tile_data = tiles.tile_data)
+        from tiles join tile_hashes h on h.tile_id = tiles.rowid""")
+    cur.execute("""drop table tile_hashes""")
+    con.commit()
 
 def compression_finalize(cur, con, silent):
     if not silent:
@@ -164,24 +174,107 @@ def compression_finalize(cur, con, silent):
         map.tile_row as tile_row,
         images.tile_data as tile_data FROM
         map JOIN images on images.tile_id = map.tile_id;""")
+    # Index builds sort every row; give them a 512 MB page cache and keep
+    # the sorter's temporary data in memory.
+    cur.execute("""PRAGMA cache_size=-524288""")
+    cur.execute("""PRAGMA temp_store=MEMORY""")
     cur.execute("""
           CREATE UNIQUE INDEX map_index on map
             (zoom_level, tile_column, tile_row);""")
     cur.execute("""
           CREATE UNIQUE INDEX images_id on images
             (tile_id);""")
+    # ANALYZE and VACUUM are left to optimize_database, which runs them
+    # once each, ANALYZE first, right after this.
 
-    # Workaround for python>=3.6.0,python<3.6.2
-    # https://bugs.python.org/issue28518
-    con.isolation_level = None
-    cur.execute("""vacuum;""")
-    con.isolation_level = ''  # reset default value of isolation_level
+def scan_dir(path):
+    with os.scandir(path) as entries:
+        return list(entries)
 
-    cur.execute("""analyze;""")
+def read_file(path):
+    # unbuffered: the whole file is wanted, so skip the BufferedReader layer
+    with open(path, 'rb', buffering=0) as f:
+        return f.read()
+
+def write_file(path, data):
+    # buffered, so a short write() is retried and a full disk raises
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def get_dir_entries(path):
+    # DirEntry.is_dir() uses the type reported by readdir, avoiding a
+    # stat() per entry on most filesystems
+    with os.scandir(path) as entries:
+        return [entry for entry in entries if entry.is_dir()]
 
 def get_dirs(path):
-    return [name for name in os.listdir(path)
-        if os.path.isdir(os.path.join(path, name))]
+    return [entry.name for entry in get_dir_entries(path)]
+
+def _iter_disk_tiles(directory_path, scheme, image_format, silent):
+    """Yield (z, x, y, ext, path) for every tile and grid file under
+    directory_path laid out according to scheme."""
+    for zoom_entry in get_dir_entries(directory_path):
+        zoom_dir = zoom_entry.name
+        if scheme == 'ags':
+            if "L" not in zoom_dir:
+                if not silent:
+                    logger.warning("You appear to be using an ags scheme on an non-arcgis Server cache.")
+            z = int(zoom_dir.replace("L", ""))
+        elif scheme == 'gwc':
+            z=int(zoom_dir[-2:])
+        else:
+            if "L" in zoom_dir:
+                if not silent:
+                    logger.warning("You appear to be using a %s scheme on an arcgis Server cache. Try using --scheme=ags instead" % scheme)
+            z = int(zoom_dir)
+        for row_entry in get_dir_entries(zoom_entry.path):
+            row_dir = row_entry.name
+            if scheme == 'ags':
+                y = flip_y(z, int(row_dir.replace("R", ""), 16))
+            elif scheme == 'gwc':
+                pass
+            elif scheme == 'zyx':
+                y = flip_y(int(z), int(row_dir))
+            else:
+                x = int(row_dir)
+            for entry in scan_dir(row_entry.path):
+                current_file = entry.name
+                if current_file == ".DS_Store":
+                    if not silent:
+                        logger.warning("Your OS is MacOS,and the .DS_Store file will be ignored.")
+                else:
+                    file_name, ext = current_file.split('.',1)
+                    if scheme == 'xyz':
+                        y = flip_y(int(z), int(file_name))
+                    elif scheme == 'ags':
+                        x = int(file_name.replace("C", ""), 16)
+                    elif scheme == 'gwc':
+                        x, y = file_name.split('_')
+                        x = int(x)
+                        y = int(y)
+                    elif scheme == 'zyx':
+                        x = int(file_name)
+                    else:
+                        y = int(file_name)
+
+                    if ext == image_format or ext == 'grid.json':
+                        yield z, x, y, ext, entry.path
+
+def bounded_map(executor, fn, iterable, limit):
+    """Like executor.map(fn, iterable), but with at most limit calls
+    submitted ahead of the consumer, so huge inputs are never queued all at
+    once. Results are yielded in input order."""
+    pending = collections.deque()
+    try:
+        for item in iterable:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= limit:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
 
 def disk_to_mbtiles(directory_path, mbtiles_file, **kwargs):
 
@@ -193,10 +286,13 @@ def disk_to_mbtiles(directory_path, mbtiles_file, **kwargs):
 
     con = mbtiles_connect(mbtiles_file, silent)
     cur = con.cursor()
-    optimize_connection(cur)
+    optimize_connection_for_bulk(cur)
     mbtiles_setup(cur)
     #~ image_format = 'png'
     image_format = kwargs.get('format', 'png')
+    scheme = kwargs.get('scheme')
+    # evaluated once so the per-tile debug lines cost nothing when disabled
+    log_debug = not silent and logger.isEnabledFor(logging.DEBUG)
 
     try:
         metadata = json.load(open(os.path.join(directory_path, 'metadata.json'), 'r'))
@@ -211,88 +307,100 @@ def disk_to_mbtiles(directory_path, mbtiles_file, **kwargs):
             logger.warning('metadata.json not found')
 
     count = 0
-    start_time = time.time()
-
-    for zoom_dir in get_dirs(directory_path):
-        if kwargs.get("scheme") == 'ags':
-            if "L" not in zoom_dir:
-                if not silent:
-                    logger.warning("You appear to be using an ags scheme on an non-arcgis Server cache.")
-            z = int(zoom_dir.replace("L", ""))
-        elif kwargs.get("scheme") == 'gwc':
-            z=int(zoom_dir[-2:])
-        else:
-            if "L" in zoom_dir:
-                if not silent:
-                    logger.warning("You appear to be using a %s scheme on an arcgis Server cache. Try using --scheme=ags instead" % kwargs.get("scheme"))
-            z = int(zoom_dir)
-        for row_dir in get_dirs(os.path.join(directory_path, zoom_dir)):
-            if kwargs.get("scheme") == 'ags':
-                y = flip_y(z, int(row_dir.replace("R", ""), 16))
-            elif kwargs.get("scheme") == 'gwc':
-                pass
-            elif kwargs.get("scheme") == 'zyx':
-                y = flip_y(int(z), int(row_dir))
+    start_time = time.monotonic()
+
+    # Rows are buffered and written with executemany() every sqlite_batch
+    # tiles, all inside the one transaction committed after the walk.
+    sqlite_batch = int(kwargs.get('sqlite_batch', 1000))
+    tile_rows = []
+    grid_rows = []
+    grid_data_rows = []
+
+    executemany = cur.executemany
+
+    def flush_rows():
+        if tile_rows:
+            executemany("""insert into tiles (zoom_level,
+                tile_column, tile_row, tile_data) values
+                (?, ?, ?, ?);""", tile_rows)
+            del tile_rows[:]
+        if grid_rows:
+            executemany("""insert into grids (zoom_level, tile_column, tile_row, grid) values (?, ?, ?, ?) """, grid_rows)
+            del grid_rows[:]
+        if grid_data_rows:
+            executemany("""insert into grid_data (zoom_level, tile_column, tile_row, key_name, key_json) values (?, ?, ?, ?, ?);""", grid_data_rows)
+            del grid_data_rows[:]
+
+    # Files are read on the worker pool while this thread parses grids and
+    # feeds SQLite, which only allows a single writer anyway.
+    max_workers = int(kwargs.get('max_workers', 8))
+    executor = kwargs.get('executor')
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def read_job(job):
+        return job, read_file(job[4])
+
+    callback_match = _CALLBACK_RE.match
+    loads = _json_loads
+    dumps = _json_dumps
+
+    jobs = _iter_disk_tiles(directory_path, scheme, image_format, silent)
+    try:
+        for (z, x, y, ext, path), file_content in bounded_map(executor, read_job, jobs, max_workers * 4):
+            if (ext == image_format):
+                if log_debug:
+                    logger.debug(' Read tile from Zoom (z): %i\tCol (x): %i\tRow (y): %i', z, x, y)
+                tile_rows.append((z, x, y, file_content))
+                if len(tile_rows) >= sqlite_batch:
+                    flush_rows()
+                count = count + 1
+                if (count % 100) == 0 and not silent:
+                    logger.info(" %s tiles inserted (%d tiles/sec)", count, count / (time.monotonic() - start_time))
             else:
-                x = int(row_dir)
-            for current_file in os.listdir(os.path.join(directory_path, zoom_dir, row_dir)):
-                if current_file == ".DS_Store" and not silent:
-                    logger.warning("Your OS is MacOS,and the .DS_Store file will be ignored.")
-                else:
-                    file_name, ext = current_file.split('.',1)
-                    f = open(os.path.join(directory_path, zoom_dir, row_dir, current_file), 'rb')
-                    file_content = f.read()
-                    f.close()
-                    if kwargs.get('scheme') == 'xyz':
-                        y = flip_y(int(z), int(file_name))
-                    elif kwargs.get("scheme") == 'ags':
-                        x = int(file_name.replace("C", ""), 16)
-                    elif kwargs.get("scheme") == 'gwc':
-                        x, y = file_name.split('_')
-                        x = int(x)
-                        y = int(y)
-                    elif kwargs.get("scheme") == 'zyx':
-                        x = int(file_name)
-                    else:
-                        y = int(file_name)
-
-                    if (ext == image_format):
-                        if not silent:
-                            logger.debug(' Read tile from Zoom (z): %i\tCol (x): %i\tRow (y): %i' % (z, x, y))
-                        cur.execute("""insert into tiles (zoom_level,
-                            tile_column, tile_row, tile_data) values
-                            (?, ?, ?, ?);""",
-                            (z, x, y, sqlite3.Binary(file_content)))
-                        count = count + 1
-                        if (count % 100) == 0 and not silent:
-                            logger.info(" %s tiles inserted (%d tiles/sec)" % (count, count / (time.time() - start_time)))
-                    elif (ext == 'grid.json'):
-                        if not silent:
-                            logger.debug(' Read grid from Zoom (z): %i\tCol (x): %i\tRow (y): %i' % (z, x, y))
-                        # Remove potential callback with regex
-                        file_content = file_content.decode('utf-8')
-                        has_callback = re.match(r'[\w\s=+-/]+\(({(.|\n)*})\);?', file_content)
-                        if has_callback:
-                            file_content = has_callback.group(1)
-                        utfgrid = json.loads(file_content)
-
-                        data = utfgrid.pop('data')
-                        compressed = zlib.compress(json.dumps(utfgrid).encode())
-                        cur.execute("""insert into grids (zoom_level, tile_column, tile_row, grid) values (?, ?, ?, ?) """, (z, x, y, sqlite3.Binary(compressed)))
-                        grid_keys = [k for k in utfgrid['keys'] if k != ""]
-                        for key_name in grid_keys:
-                            key_json = data[key_name]
-                            cur.execute("""insert into grid_data (zoom_level, tile_column, tile_row, key_name, key_json) values (?, ?, ?, ?, ?);""", (z, x, y, key_name, json.dumps(key_json)))
+                if log_debug:
+                    logger.debug(' Read grid from Zoom (z): %i\tCol (x): %i\tRow (y): %i', z, x, y)
+                # Remove potential callback with regex
+                has_callback = callback_match(file_content)
+                if has_callback:
+                    file_content = has_callback.group(1)
+                utfgrid = loads(file_content)
+
+                data = utfgrid.pop('data')
+                # Level 1: grids are repetitive text and come out nearly as
+                # small as at the default level 6, for a fraction of the CPU.
+                compressed = zlib.compress(dumps(utfgrid), 1)
+                grid_rows.append((z, x, y, compressed))
+                grid_keys = [k for k in utfgrid['keys'] if k != ""]
+                for key_name in grid_keys:
+                    key_json = data[key_name]
+                    grid_data_rows.append((z, x, y, key_name, dumps(key_json).decode('utf-8')))
+                if len(grid_rows) >= sqlite_batch or len(grid_data_rows) >= sqlite_batch:
+                    flush_rows()
+    finally:
+        if own_executor:
+            executor.shutdown(wait=True)
+
+    flush_rows()
+    con.commit()
 
     if not silent:
         logger.debug('tiles (and grids) inserted.')
 
-    if kwargs.get('compression', False):
+    compression = kwargs.get('compression', False)
+    if compression:
         compression_prepare(cur, silent)
-        compression_do(cur, con, 256, silent)
+        compression_do(cur, con, silent)
         compression_finalize(cur, con, silent)
 
-    optimize_database(con, silent)
+    # A freshly imported database has no free pages to reclaim, so it is
+    # only rewritten by VACUUM when asked to, or after compression has
+    # dropped the original tiles table.
+    vacuum = kwargs.get('vacuum')
+    if vacuum is None:
+        vacuum = compression
+    optimize_database(con, silent, vacuum)
     con.close()
 
 def mbtiles_metadata_to_disk(mbtiles_file, **kwargs):
@@ -302,7 +410,51 @@ def mbtiles_metadata_to_disk(mbtiles_file, **kwargs):
     con = mbtiles_connect(mbtiles_file, silent)
     metadata = dict(con.execute('select name, value from metadata;').fetchall())
     if not silent:
-        logger.debug(json.dumps(metadata, indent=2))
+        logger.info(json.dumps(metadata, indent=2))
+
+def has_grids(con):
+    """Whether the database has a grids table (or view) at all."""
+    return con.execute("select 1 from sqlite_master where name = 'grids';").fetchone() is not None
+
+def iter_grids(con):
+    """Yield (zoom_level, tile_column, tile_row, grid_blob, data) for every
+    UTFGrid in the database. grid_blob is the stored (zlib compressed) grid
+    and data the key -> JSON value dict joined in from grid_data."""
+    if not has_grids(con):
+        return
+    rows = con.execute('''select grids.zoom_level, grids.tile_column,
+            grids.tile_row, grids.grid, grid_data.key_name, grid_data.key_json
+        from grids left join grid_data on
+            grid_data.zoom_level = grids.zoom_level and
+            grid_data.tile_column = grids.tile_column and
+            grid_data.tile_row = grids.tile_row
+        order by grids.zoom_level, grids.tile_column, grids.tile_row;''')
+    for _, joined in itertools.groupby(rows, key=lambda r: r[:3]):
+        first = next(joined)
+        data = {}
+        for row in itertools.chain((first,), joined):
+            if row[4] is not None:
+                data[row[4]] = _json_loads(row[5])
+        yield first[0], first[1], first[2], first[3], data
+
+def grid_body(grid_blob, data, callback=None):
+    """Return the exported bytes of a stored UTFGrid merged with its data,
+    wrapped in callback(...); unless callback is empty, "false" or "null"."""
+    raw = zlib.decompress(grid_blob).rstrip()
+    body = raw[:-1].rstrip()
+    if (not data and raw.endswith(b'}') and not body.endswith(b'{')
+            and b'"data"' not in raw):
+        # Nothing to merge: splice an empty data member onto the stored
+        # (non-empty, data-less) JSON object instead of parsing and
+        # re-serializing the whole grid.
+        raw = body + b',"data":{}}'
+    else:
+        grid_json = _json_loads(raw)
+        grid_json['data'] = data
+        raw = _json_dumps(grid_json)
+    if callback in (None, "", "false", "null"):
+        return raw
+    return b'%s(%s);' % (callback.encode('utf-8'), raw)
 
 def mbtiles_to_disk(mbtiles_file, directory_path, **kwargs):
     silent = kwargs.get('silent')
@@ -313,8 +465,6 @@ def mbtiles_to_disk(mbtiles_file, directory_path, **kwargs):
     os.mkdir("%s" % directory_path)
     metadata = dict(con.execute('select name, value from metadata;').fetchall())
     json.dump(metadata, open(os.path.join(directory_path, 'metadata.json'), 'w'), indent=4)
-    count = con.execute('select count(zoom_level) from tiles;').fetchone()[0]
-    done = 0
     base_path = directory_path
     if not os.path.isdir(base_path):
         os.makedirs(base_path)
@@ -326,84 +476,88 @@ def mbtiles_to_disk(mbtiles_file, directory_path, **kwargs):
         formatter_json = {"formatter":formatter}
         open(layer_json, 'w').write(json.dumps(formatter_json))
 
-    tiles = con.execute('select zoom_level, tile_column, tile_row, tile_data from tiles;')
-    t = tiles.fetchone()
-    while t:
-        z = t[0]
-        x = t[1]
-        y = t[2]
-        if kwargs.get('scheme') == 'xyz':
-            y = flip_y(z,y)
-            if not silent:
-                logger.debug('flipping')
-            tile_dir = os.path.join(base_path, str(z), str(x))
-        elif kwargs.get('scheme') == 'wms':
-            tile_dir = os.path.join(base_path,
-                "%02d" % (z),
-                "%03d" % (int(x) / 1000000),
-                "%03d" % ((int(x) / 1000) % 1000),
-                "%03d" % (int(x) % 1000),
-                "%03d" % (int(y) / 1000000),
-                "%03d" % ((int(y) / 1000) % 1000))
-        else:
-            tile_dir = os.path.join(base_path, str(z), str(x))
-        if not os.path.isdir(tile_dir):
-            os.makedirs(tile_dir)
-        if kwargs.get('scheme') == 'wms':
-            tile = os.path.join(tile_dir,'%03d.%s' % (int(y) % 1000, kwargs.get('format', 'png')))
-        else:
-            tile = os.path.join(tile_dir,'%s.%s' % (y, kwargs.get('format', 'png')))
-        f = open(tile, 'wb')
-        f.write(t[3])
-        f.close()
-        done = done + 1
+    if kwargs.get('metadata_only'):
         if not silent:
-            logger.info('%s / %s tiles exported' % (done, count))
-        t = tiles.fetchone()
+            logger.debug('metadata exported, skipping tiles and grids')
+        con.close()
+        return
+
+    log_debug = not silent and logger.isEnabledFor(logging.DEBUG)
+    log_info = not silent and logger.isEnabledFor(logging.INFO)
+    scheme = kwargs.get('scheme')
+    image_format = kwargs.get('format', 'png')
+    created_dirs = set()
+
+    def makedirs(path):
+        if path not in created_dirs:
+            os.makedirs(path, exist_ok=True)
+            created_dirs.add(path)
+
+    def tile_jobs():
+        tiles = con.execute('select zoom_level, tile_column, tile_row, tile_data from tiles;')
+        for t in tiles:
+            z = t[0]
+            x = t[1]
+            y = t[2]
+            if scheme == 'xyz':
+                y = flip_y(z,y)
+                if log_debug:
+                    logger.debug('flipping')
+                tile_dir = os.path.join(base_path, str(z), str(x))
+            elif scheme == 'wms':
+                dirs, stem = wms_dirs(z, x, y)
+                tile_dir = os.path.join(base_path, *dirs)
+            else:
+                tile_dir = os.path.join(base_path, str(z), str(x))
+            makedirs(tile_dir)
+            if scheme == 'wms':
+                tile = os.path.join(tile_dir,'%s.%s' % (stem, image_format))
+            else:
+                tile = os.path.join(tile_dir,'%s.%s' % (y, image_format))
+            yield tile, t[3]
 
     # grids
     callback = kwargs.get('callback')
-    done = 0
+
+    def grid_jobs():
+        for zoom_level, tile_column, y, grid_blob, data in iter_grids(con):
+            if scheme == 'xyz':
+                y = flip_y(zoom_level,y)
+            grid_dir = os.path.join(base_path, str(zoom_level), str(tile_column))
+            makedirs(grid_dir)
+            grid = os.path.join(grid_dir,'%s.grid.json' % (y))
+            yield grid, grid_body(grid_blob, data, callback)
+
+    def write_job(job):
+        write_file(*job)
+
+    # Rows are read and directories created on this thread; the file writes
+    # themselves go to the worker pool.
+    max_workers = int(kwargs.get('max_workers', 8))
+    executor = kwargs.get('executor')
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=max_workers)
     try:
-        count = con.execute('select count(zoom_level) from grids;').fetchone()[0]
-        grids = con.execute('select zoom_level, tile_column, tile_row, grid from grids;')
-        g = grids.fetchone()
-    except sqlite3.OperationalError:
-        g = None # no grids table
-    while g:
-        zoom_level = g[0] # z
-        tile_column = g[1] # x
-        y = g[2] # y
-        grid_data_cursor = con.execute('''select key_name, key_json FROM
-            grid_data WHERE
-            zoom_level = %(zoom_level)d and
-            tile_column = %(tile_column)d and
-            tile_row = %(y)d;''' % locals() )
-        if kwargs.get('scheme') == 'xyz':
-            y = flip_y(zoom_level,y)
-        grid_dir = os.path.join(base_path, str(zoom_level), str(tile_column))
-        if not os.path.isdir(grid_dir):
-            os.makedirs(grid_dir)
-        grid = os.path.join(grid_dir,'%s.grid.json' % (y))
-        f = open(grid, 'w')
-        grid_json = json.loads(zlib.decompress(g[3]).decode('utf-8'))
-        # join up with the grid 'data' which is in pieces when stored in mbtiles file
-        grid_data = grid_data_cursor.fetchone()
-        data = {}
-        while grid_data:
-            data[grid_data[0]] = json.loads(grid_data[1])
-            grid_data = grid_data_cursor.fetchone()
-        grid_json['data'] = data
-        if callback in (None, "", "false", "null"):
-            f.write(json.dumps(grid_json))
+        count = con.execute('select count(zoom_level) from tiles;').fetchone()[0]
+        done = 0
+        for _ in bounded_map(executor, write_job, tile_jobs(), max_workers * 4):
+            done = done + 1
+            if log_info:
+                logger.info('%s / %s tiles exported', done, count)
+
+        if has_grids(con):
+            count = con.execute('select count(zoom_level) from grids;').fetchone()[0]
         else:
-            f.write('%s(%s);' % (callback, json.dumps(grid_json)))
-        f.close()
-        done = done + 1
-        if not silent:
-            logger.info('%s / %s grids exported' % (done, count))
-        g = grids.fetchone()
-
+            count = 0 # no grids table
+        done = 0
+        for _ in bounded_map(executor, write_job, grid_jobs(), max_workers * 4):
+            done = done + 1
+            if log_info:
+                logger.info('%s / %s grids exported', done, count)
+    finally:
+        if own_executor:
+            executor.shutdown(wait=True)
 
 # ---- S3 Export ----
 def mbtiles_to_s3(mbtiles_file, bucket, **kwargs):
@@ -438,7 +592,8 @@ def mbtiles_to_s3(mbtiles_file, bucket, **kwargs):
         Optional Content-Encoding header. If set (e.g., 'gzip'), objects will be uploaded as-is
         but with the given ContentEncoding metadata applied. This assumes payloads are already encoded.
     max_pool_connections : int
-        HTTP connection pool size for the S3 client. Defaults to 64.
+        HTTP connection pool size for the S3 client. Defaults to 64, and is
+        raised to max_workers if that is larger.
     connect_timeout : int
         Socket connect timeout in seconds. Defaults to 60.
     read_timeout : int
@@ -457,6 +612,9 @@ def mbtiles_to_s3(mbtiles_file, bucket, **kwargs):
         Custom S3-compatible endpoint URL. Optional.
     max_workers : int
         Number of threads for parallel uploads. Defaults to 32.
+    executor : concurrent.futures.Executor
+        Optional shared executor to submit uploads to instead of creating a
+        private thread pool. It is not shut down by this function.
     inflight_factor : int
         Backpressure threshold factor (in-flight futures per worker). Defaults to 8.
     sqlite_batch : int
@@ -469,10 +627,14 @@ def mbtiles_to_s3(mbtiles_file, bucket, **kwargs):
     """
 
     silent = kwargs.get('silent')
-    if silent:
-        logging.basicConfig(level=logging.ERROR)
 
-    if boto3 is None:
+    # boto3 is imported here rather than at module level so that disk-only
+    # users (and the CLI) don't pay for loading botocore.
+    try:
+        import boto3
+        from botocore.exceptions import BotoCoreError, ClientError
+        from botocore.config import Config
+    except ImportError:
         raise RuntimeError("boto3 is required to use mbtiles_to_s3 but was not importable.")
 
     bucket = bucket.strip().replace("s3://", "").replace("/", "")
@@ -487,6 +649,10 @@ def mbtiles_to_s3(mbtiles_file, bucket, **kwargs):
     #   retries_mode / retries_max_attempts: override retry behavior
     #   endpoint_url: custom endpoint (e.g., S3-compatible storage)
     max_pool_connections = int(kwargs.get('max_pool_connections', 64))
+    max_workers = int(kwargs.get('max_workers', 32))
+    # Every upload thread needs its own connection; with a smaller pool
+    # urllib3 discards and reopens connections ("Connection pool is full").
+    max_pool_connections = max(max_pool_connections, max_workers)
     connect_timeout = int(kwargs.get('connect_timeout', 60))
     read_timeout = int(kwargs.get('read_timeout', 120))
     tcp_keepalive = bool(kwargs.get('tcp_keepalive', True))
@@ -503,28 +669,24 @@ def mbtiles_to_s3(mbtiles_file, bucket, **kwargs):
             use_accel, use_dualstack, retries_mode, retries_max_attempts,
         )
 
-    if Config is not None:
-        cfg_kwargs = {
-            'max_pool_connections': max_pool_connections,
-            'connect_timeout': connect_timeout,
-            'read_timeout': read_timeout,
-            'tcp_keepalive': tcp_keepalive,
-            's3': {
-                'use_accelerate_endpoint': use_accel,
-                'use_dualstack_endpoint': use_dualstack,
-            },
+    cfg_kwargs = {
+        'max_pool_connections': max_pool_connections,
+        'connect_timeout': connect_timeout,
+        'read_timeout': read_timeout,
+        'tcp_keepalive': tcp_keepalive,
+        's3': {
+            'use_accelerate_endpoint': use_accel,
+            'use_dualstack_endpoint': use_dualstack,
+        },
+    }
+    # Only set retries if user provided explicit overrides; otherwise env/AWS config wins
+    if retries_mode or retries_max_attempts:
+        cfg_kwargs['retries'] = {
+            **({'mode': retries_mode} if retries_mode else {}),
+            **({'max_attempts': int(retries_max_attempts)} if retries_max_attempts else {}),
         }
-        # Only set retries if user provided explicit overrides; otherwise env/AWS config wins
-        if retries_mode or retries_max_attempts:
-            cfg_kwargs['retries'] = {
-                **({'mode': retries_mode} if retries_mode else {}),
-                **({'max_attempts': int(retries_max_attempts)} if retries_max_attempts else {}),
-            }
-        client_config = Config(**cfg_kwargs)
-        s3 = boto3.client('s3', config=client_config, endpoint_url=endpoint_url)
-    else:
-        # Fallback (should not happen in normal boto3 installs)
-        s3 = boto3.client('s3', endpoint_url=endpoint_url)
+    client_config = Config(**cfg_kwargs)
+    s3 = boto3.client('s3', config=client_config, endpoint_url=endpoint_url)
 
     prefix = kwargs.get('prefix', '').strip('/')
     scheme = kwargs.get('scheme')
@@ -533,10 +695,12 @@ def mbtiles_to_s3(mbtiles_file, bucket, **kwargs):
     cache_control = kwargs.get('cache_control')
     content_type_override = kwargs.get('content_type_override')
     content_encoding = kwargs.get('content_encoding')
-    max_workers = int(kwargs.get('max_workers', 32))
     inflight_factor = int(kwargs.get('inflight_factor', 8))  # number of in-flight futures per worker before draining
     sqlite_batch = int(kwargs.get('sqlite_batch', 5000))
 
+    # Tile keys are built on the hot path, so the prefix is joined once here
+    key_prefix = prefix + '/' if prefix else ''
+
     def _join_key(*parts):
         parts = [p for p in parts if p not in (None, '', '/')]
         return '/'.join(str(p).strip('/') for p in parts)
@@ -601,156 +765,103 @@ def mbtiles_to_s3(mbtiles_file, bucket, **kwargs):
             if not silent:
                 logger.warning("Could not upload layer.json: %s" % e)
 
-    # Thread pool for parallel S3 uploads
-    executor = ThreadPoolExecutor(max_workers=max_workers)
-    upload_futures = []
+    # Thread pool for parallel S3 uploads (reuse the caller's if given)
+    executor = kwargs.get('executor')
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=max_workers)
 
-    def _submit_upload(put_args):
+    def _upload(put_args):
         # Use the existing s3 client; botocore clients are generally thread-safe for requests
-        return executor.submit(s3.put_object, **put_args)
-
-    # Apply simple backpressure to avoid unbounded memory usage
-    def _drain_completed(limit):
-        nonlocal done
-        drained = 0
-        for f in list(upload_futures):
-            if f.done():
-                upload_futures.remove(f)
-                try:
-                    f.result()
-                    done += 1
-                    if (done % 1000 == 0):
-                        logger.info('%s tiles uploaded' % done)
-                except (BotoCoreError, ClientError) as e:
-                    logger.error('Tile upload failed: %s', e)
-                drained += 1
-                if drained >= limit:
-                    break
+        try:
+            s3.put_object(**put_args)
+        except (BotoCoreError, ClientError) as e:
+            return put_args, e
+        return put_args, None
 
     # Stream tiles from SQLite to S3 in batches to reduce SQLite round-trips
-    tiles_cur = con.cursor()
-    tiles_cur.execute('select zoom_level, tile_column, tile_row, tile_data from tiles;')
-    done = 0
-
-    while True:
-        rows = tiles_cur.fetchmany(sqlite_batch)
-        if not rows:
-            break
-        for (z, x, y, data) in rows:
-            # Path layout compatibility with mbtiles_to_disk
+    def _tile_uploads():
+        content_type = _guess_content_type(image_ext)
+        tiles_cur = con.cursor()
+        tiles_cur.execute('select zoom_level, tile_column, tile_row, tile_data from tiles;')
+        while True:
+            rows = tiles_cur.fetchmany(sqlite_batch)
+            if not rows:
+                break
+            for (z, x, y, data) in rows:
+                # Path layout compatibility with mbtiles_to_disk
+                if scheme == 'xyz':
+                    y = flip_y(z, y)
+                if scheme == 'wms':
+                    # WMS-style shard directories; use same naming as mbtiles_to_disk
+                    dirs, stem = wms_dirs(z, x, y)
+                    key = f"{key_prefix}{'/'.join(dirs)}/{stem}.{image_ext}"
+                else:
+                    # Default TMS (or flipped xyz): z/x/y
+                    key = f"{key_prefix}{z}/{x}/{y}.{image_ext}"
+
+                # Build arguments for upload and submit to thread pool
+                put_args = {
+                    'Bucket': bucket,
+                    'Key': key,
+                    'Body': data,
+                    'ContentType': content_type
+                }
+                if cache_control:
+                    put_args['CacheControl'] = cache_control
+                if content_encoding:
+                    put_args['ContentEncoding'] = content_encoding
+                yield put_args
+
+    def _grid_uploads():
+        for zoom_level, tile_column, y, grid_blob, data in iter_grids(con):
             if scheme == 'xyz':
-                y = flip_y(z, y)
-                tile_dir_parts = (prefix, str(z), str(x))
-            elif scheme == 'wms':
-                # WMS-style shard directories; use same naming as mbtiles_to_disk
-                tile_dir_parts = (
-                    prefix,
-                    "%02d" % (z),
-                    "%03d" % (int(x) / 1000000),
-                    "%03d" % ((int(x) / 1000) % 1000),
-                    "%03d" % (int(x) % 1000),
-                    "%03d" % (int(y) / 1000000),
-                    "%03d" % ((int(y) / 1000) % 1000)
-                )
-            else:
-                # Default TMS: z/x/y
-                tile_dir_parts = (prefix, str(z), str(x))
+                y = flip_y(zoom_level, y)
 
-            filename = ('%03d.%s' % (int(y) % 1000, image_ext)) if scheme == 'wms' else ('%s.%s' % (y, image_ext))
-            key = _join_key(*tile_dir_parts, filename)
+            if scheme == 'wms':
+                dirs, _ = wms_dirs(zoom_level, tile_column, y)
+                grid_key = f"{key_prefix}{'/'.join(dirs)}/{y}.grid.json"
+            else:
+                grid_key = f"{key_prefix}{zoom_level}/{tile_column}/{y}.grid.json"
 
-            # Build arguments for upload and submit to thread pool
             put_args = {
                 'Bucket': bucket,
-                'Key': key,
-                'Body': data,
-                'ContentType': _guess_content_type(image_ext)
+                'Key': grid_key,
+                'Body': grid_body(grid_blob, data, callback),
+                'ContentType': 'application/json; charset=utf-8'
             }
             if cache_control:
                 put_args['CacheControl'] = cache_control
-            if content_encoding:
-                put_args['ContentEncoding'] = content_encoding
-
-            upload_futures.append(_submit_upload(put_args))
-
-            # Backpressure: if too many in-flight, drain some completed
-            if len(upload_futures) >= max_workers * inflight_factor:
-                _drain_completed(limit=max_workers)
+            yield put_args
 
-    # Wait for all remaining uploads to finish
-    for f in upload_futures:
-        try:
-            f.result()
-            done += 1
-            if (done % 1000 == 0):
-                logger.info('%s tiles uploaded' % done)
-        except (BotoCoreError, ClientError) as e:
-            logger.error('Tile upload failed: %s', e)
-
-    executor.shutdown(wait=True)
-
-    if not silent:
-        logger.debug('tile upload complete (%d tiles, sqlite_batch=%d).' % (done, sqlite_batch))
-
-    # UTFGrid export (if present)
-    callback = kwargs.get('callback')
+    # Backpressure: bounded_map keeps at most max_workers * inflight_factor
+    # uploads in flight, so memory stays flat however many tiles there are
+    inflight = max_workers * inflight_factor
     try:
-        count = con.execute('select count(zoom_level) from grids;').fetchone()[0]
-        grids = con.execute('select zoom_level, tile_column, tile_row, grid from grids;')
-        g = grids.fetchone()
-    except sqlite3.OperationalError:
-        g = None
-
-    grids_done = 0
-    while g:
-        zoom_level, tile_column, y, grid_blob = g[0], g[1], g[2], g[3]
-
-        grid_data_cursor = con.execute(
-            'select key_name, key_json from grid_data where zoom_level = ? and tile_column = ? and tile_row = ?',
-            (zoom_level, tile_column, y)
-        )
-
-        if scheme == 'xyz':
-            y = flip_y(zoom_level, y)
-
-        grid_dir_parts = (prefix, str(zoom_level), str(tile_column)) if scheme != 'wms' else (
-            prefix,
-            "%02d" % (zoom_level),
-            "%03d" % (int(tile_column) / 1000000),
-            "%03d" % ((int(tile_column) / 1000) % 1000),
-            "%03d" % (int(tile_column) % 1000),
-            "%03d" % (int(y) / 1000000),
-            "%03d" % ((int(y) / 1000) % 1000)
-        )
-
-        grid_key = _join_key(*grid_dir_parts, '%s.grid.json' % y)
-
-        grid_json = json.loads(zlib.decompress(grid_blob).decode('utf-8'))
-        data = {}
-        row = grid_data_cursor.fetchone()
-        while row:
-            data[row[0]] = json.loads(row[1])
-            row = grid_data_cursor.fetchone()
-        grid_json['data'] = data
-
-        body = json.dumps(grid_json).encode('utf-8') if callback in (None, '', 'false', 'null') else ('%s(%s);' % (callback, json.dumps(grid_json))).encode('utf-8')
-
-        try:
-            s3.put_object(
-                Bucket=bucket,
-                Key=grid_key,
-                Body=body,
-                ContentType='application/json; charset=utf-8',
-                CacheControl=cache_control if cache_control else None
-            )
-            grids_done += 1
-            if not silent and (grids_done % 100 == 0):
-                logger.info('%s grids uploaded' % grids_done)
-        except (BotoCoreError, ClientError) as e:
-            if not silent:
-                logger.error('Failed to upload grid z=%s x=%s y=%s to %s: %s' % (zoom_level, tile_column, y, grid_key, e))
+        done = 0
+        for put_args, e in bounded_map(executor, _upload, _tile_uploads(), inflight):
+            if e is None:
+                done += 1
+                if not silent and (done % 1000 == 0):
+                    logger.info('%s tiles uploaded', done)
+            else:
+                logger.error('Tile upload failed: %s', e)
 
-        g = grids.fetchone()
+        if not silent:
+            logger.debug('tile upload complete (%d tiles, sqlite_batch=%d).' % (done, sqlite_batch))
+
+        # UTFGrid export (if present)
+        grids_done = 0
+        for put_args, e in bounded_map(executor, _upload, _grid_uploads(), inflight):
+            if e is None:
+                grids_done += 1
+                if not silent and (grids_done % 100 == 0):
+                    logger.info('%s grids uploaded', grids_done)
+            elif not silent:
+                logger.error('Failed to upload grid to %s: %s', put_args['Key'], e)
+    finally:
+        if own_executor:
+            executor.shutdown(wait=True)
 
     if not silent and grids_done:
         logger.debug('grid upload complete (%d grids).' % grids_done)
@@ -0,0 +1,42 @@
+import pytest
+
+# The suite runs under pytest-xdist (see the hatch "test" script). Each
+# worker is its own process, so session-scoped fixtures here and in test.py
+# (moto, the S3 client, the decoded tilesets) are rebuilt once per worker;
+# they only write under tmp_path_factory, which xdist keeps separate per
+# worker. --dist=loadfile is deliberately not used: every test lives in
+# test/test.py, so it would put the whole suite on a single worker.
+
+BUCKET = "test-bucket"
+REGION = "ap-northeast-1"
+
+@pytest.fixture(scope="session", autouse=True)
+def aws_dummy_creds():
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv("AWS_ACCESS_KEY_ID", "x")
+        mp.setenv("AWS_SECRET_ACCESS_KEY", "x")
+        mp.setenv("AWS_DEFAULT_REGION", REGION)
+        yield
+
+@pytest.fixture(scope="session")
+def _moto(aws_dummy_creds):
+    """Install moto's AWS interception once for the whole session rather
+    than around each S3 test. boto3 and moto are imported here so that
+    runs without S3 tests never load them."""
+    from moto import mock_aws
+    mock = mock_aws()
+    mock.start()
+    yield
+    mock.stop()
+
+@pytest.fixture(scope="session")
+def s3_client(_moto):
+    """One moto-backed S3 client for the whole session; building a boto3
+    client is expensive, so tests share it."""
+    import boto3
+    return boto3.session.Session().client("s3", region_name=REGION)
+
+@pytest.fixture(scope="session")
+def bucket(s3_client):
+    s3_client.create_bucket(Bucket=BUCKET, CreateBucketConfiguration={"LocationConstraint": REGION})
+    return BUCKET
@@ -1,83 +1,217 @@
 import os
 import shutil
 import json
+import sqlite3
+import zlib
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
 import pytest
-import boto3
-from moto import mock_aws
-from mbutil.util import mbtiles_to_disk, disk_to_mbtiles, mbtiles_to_s3
+import mbutil.cli
+import mbutil.util
+from mbutil.util import mbtiles_to_disk, disk_to_mbtiles, mbtiles_to_s3, grid_body, iter_grids
 
-@pytest.fixture(autouse=True)
-def clear_data_each_test():
-    yield
+DATA = pathlib.Path(__file__).parent / 'data'
+ONE_TILE = DATA / 'one_tile.mbtiles'
+UTF8GRID = DATA / 'utf8grid.mbtiles'
+ZYX = DATA / 'tiles' / 'zyx'
+
+def names_in(path):
+    """Names in directory path, from a single scandir() instead of a stat()
+    per asserted file."""
+    with os.scandir(str(path)) as entries:
+        return {entry.name for entry in entries}
+
+@pytest.fixture
+def memory_mbtiles(request, monkeypatch):
+    """URI of a shared-cache in-memory database for an intermediate mbtiles
+    that is only read back; a keeper connection holds it open for the test.
+    mbutil opens plain paths, so mbtiles_connect is patched to accept the URI."""
+    uri = 'file:%s?mode=memory&cache=shared' % request.node.name
+    real_connect = mbutil.util.mbtiles_connect
+
+    def connect(mbtiles_file, silent):
+        if mbtiles_file == uri:
+            return sqlite3.connect(uri, uri=True)
+        return real_connect(mbtiles_file, silent)
+
+    keeper = sqlite3.connect(uri, uri=True)
+    monkeypatch.setattr(mbutil.util, 'mbtiles_connect', connect)
+    yield uri
+    keeper.close()
+
+def _link_or_copy(src, dst):
+    # hardlinks fail across filesystems and on filesystems without
+    # link support; copy there instead
     try:
-        shutil.rmtree('test/output')
-    except Exception:
-        pass
-
-BUCKET = "test-bucket"
-
-@pytest.fixture(autouse=True)
-def aws_dummy_creds(monkeypatch):
-    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "x")
-    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "x")
-    monkeypatch.setenv("AWS_DEFAULT_REGION", "ap-northeast-1")
-
-def test_mbtiles_to_disk():
-    mbtiles_to_disk('test/data/one_tile.mbtiles', 'test/output')
-    assert os.path.exists('test/output/0/0/0.png')
-    assert os.path.exists('test/output/metadata.json')
-
-def test_mbtiles_to_disk_and_back():
-    mbtiles_to_disk('test/data/one_tile.mbtiles', 'test/output')
-    assert os.path.exists('test/output/0/0/0.png')
-    disk_to_mbtiles('test/output/', 'test/output/one.mbtiles')
-    assert os.path.exists('test/output/one.mbtiles')
-
-def test_utf8grid_mbtiles_to_disk():
-    mbtiles_to_disk('test/data/utf8grid.mbtiles', 'test/output')
-    assert os.path.exists('test/output/0/0/0.grid.json')
-    assert os.path.exists('test/output/0/0/0.png')
-    assert os.path.exists('test/output/metadata.json')
-
-def test_utf8grid_disk_to_mbtiles():
-    os.mkdir('test/output')
-    mbtiles_to_disk('test/data/utf8grid.mbtiles', 'test/output/original', callback=None)
-    disk_to_mbtiles('test/output/original/', 'test/output/imported.mbtiles')
-    mbtiles_to_disk('test/output/imported.mbtiles', 'test/output/imported', callback=None)
-    assert os.path.exists('test/output/imported/0/0/0.grid.json')
-    original = json.load(open('test/output/original/0/0/0.grid.json'))
-    imported = json.load(open('test/output/imported/0/0/0.grid.json'))
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def clone_tree(src, dst):
+    """Materialize src at dst with hardlinks, without copying file data."""
+    shutil.copytree(str(src), str(dst), copy_function=_link_or_copy)
+
+# Exports shared by the tests that only need them as import input; tests
+# get hardlinked copies so they may add files without touching the cache.
+@pytest.fixture(scope="session")
+def decoded_one_tile(tmp_path_factory):
+    decoded = tmp_path_factory.mktemp("one_tile") / 'tiles'
+    mbtiles_to_disk(str(ONE_TILE), str(decoded))
+    return decoded
+
+@pytest.fixture(scope="session")
+def decoded_utf8grid(tmp_path_factory):
+    decoded = tmp_path_factory.mktemp("utf8grid") / 'tiles'
+    mbtiles_to_disk(str(UTF8GRID), str(decoded), callback=None)
+    return decoded
+
+def test_one_tile_conversion(tmp_path, decoded_one_tile):
+    # export (done once by the session fixture) ...
+    assert '0.png' in names_in(decoded_one_tile / '0/0')
+    assert 'metadata.json' in names_in(decoded_one_tile)
+    # ... and back
+    output = tmp_path / 'output'
+    clone_tree(decoded_one_tile, output)
+    disk_to_mbtiles(str(output), str(output / 'one.mbtiles'))
+    assert 'one.mbtiles' in names_in(output)
+
+def test_mbtiles_to_disk_metadata_only(tmp_path):
+    output = tmp_path / 'output'
+    mbtiles_to_disk(str(UTF8GRID), str(output), metadata_only=True)
+    assert (output / 'metadata.json').exists()
+    assert not (output / '0').exists()
+
+def test_utf8grid_mbtiles_to_disk(tmp_path):
+    output = tmp_path / 'output'
+    mbtiles_to_disk(str(UTF8GRID), str(output))
+    assert {'0.grid.json', '0.png'} <= names_in(output / '0/0')
+    assert 'metadata.json' in names_in(output)
+
+def test_utf8grid_disk_to_mbtiles(tmp_path, decoded_utf8grid, memory_mbtiles):
+    output = tmp_path / 'output'
+    output.mkdir(parents=True, exist_ok=True)
+    clone_tree(decoded_utf8grid, output / 'original')
+    disk_to_mbtiles(str(output / 'original'), memory_mbtiles)
+    # read the imported grid straight from the database instead of exporting it again
+    con = sqlite3.connect(memory_mbtiles, uri=True)
+    grids = {(z, x, y): grid_body(blob, data) for z, x, y, blob, data in iter_grids(con)}
+    con.close()
+    imported = json.loads(grids[(0, 0, 0)])
+    original = json.loads((output / 'original/0/0/0.grid.json').read_bytes())
     assert original['data']['77'] == imported['data']['77'] == {'ISO_A2': 'FR'}
 
-def test_mbtiles_to_disk_utfgrid_callback():
-    os.mkdir('test/output')
-    callback = {}
-    for c in ['null', 'foo']:
-        mbtiles_to_disk('test/data/utf8grid.mbtiles', 'test/output/%s' % c, callback=c)
-        f = open('test/output/%s/0/0/0.grid.json' % c)
-        callback[c] = f.read().split('{')[0]
-        f.close()
-    assert callback['foo'] == 'foo('
-    assert callback['null'] == ''
-
-def test_disk_to_mbtiles_zyx():
-    os.mkdir('test/output')
-    disk_to_mbtiles('test/data/tiles/zyx', 'test/output/zyx.mbtiles', scheme='zyx', format='png')
-    mbtiles_to_disk('test/output/zyx.mbtiles', 'test/output/tiles', callback=None)
-    assert os.path.exists('test/output/tiles/3/1/5.png')
-
-@mock_aws
-def test_mbtiles_to_s3_uploads_objects():
-    region = "ap-northeast-1"
-    s3 = boto3.client("s3", region_name=region)
-    create_params = {"Bucket": BUCKET}
-    if region != "us-east-1":
-        create_params["CreateBucketConfiguration"] = {"LocationConstraint": region}
-    s3.create_bucket(**create_params)
-
-    mbtiles = os.path.join("test", "data", "one_tile.mbtiles")
+def test_utf8grid_callback_disk_to_mbtiles(tmp_path, memory_mbtiles):
+    # grids exported with a JSONP callback are unwrapped again on import
+    exported = tmp_path / 'exported'
+    mbtiles_to_disk(str(UTF8GRID), str(exported), callback='grid')
+    assert (exported / '0/0/0.grid.json').read_bytes().startswith(b'grid({')
+    disk_to_mbtiles(str(exported), memory_mbtiles)
+    con = sqlite3.connect(memory_mbtiles, uri=True)
+    grids = {(z, x, y): grid_body(blob, data) for z, x, y, blob, data in iter_grids(con)}
+    con.close()
+    imported = json.loads(grids[(0, 0, 0)])
+    assert imported['data']['77'] == {'ISO_A2': 'FR'}
+
+@pytest.fixture(params=['json', 'orjson'])
+def json_backend(request, monkeypatch):
+    """Run with mbutil.util's grid (de)serializers set to the stdlib json
+    fallback or to orjson (skipped when orjson isn't installed)."""
+    if request.param == 'orjson':
+        orjson = pytest.importorskip('orjson')
+        dumps, loads = orjson.dumps, orjson.loads
+    else:
+        dumps, loads = (lambda obj: json.dumps(obj).encode('utf-8')), json.loads
+    monkeypatch.setattr(mbutil.util, '_json_dumps', dumps)
+    monkeypatch.setattr(mbutil.util, '_json_loads', loads)
+    return request.param
+
+def test_utf8grid_round_trip_json_backends(tmp_path, decoded_utf8grid, json_backend):
+    mbtiles = tmp_path / 'utf8grid.mbtiles'
+    disk_to_mbtiles(str(decoded_utf8grid), str(mbtiles))
+    exported = tmp_path / 'exported'
+    mbtiles_to_disk(str(mbtiles), str(exported), callback=None)
+    original = json.loads((decoded_utf8grid / '0/0/0.grid.json').read_bytes())
+    assert json.loads((exported / '0/0/0.grid.json').read_bytes()) == original
+
+@pytest.mark.parametrize("callback,expected", [("null", ""), ("foo", "foo(")])
+def test_mbtiles_to_disk_utfgrid_callback(tmp_path, callback, expected):
+    output = tmp_path / 'output'
+    mbtiles_to_disk(str(UTF8GRID), str(output), callback=callback)
+    # the callback wrapper is only a few bytes; don't read the whole grid
+    with open(str(output / '0/0/0.grid.json'), 'rb') as f:
+        head = f.read(16)
+    brace = head.find(b'{')
+    assert (head[:brace] if brace != -1 else head) == expected.encode()
+
+def test_mbtiles_to_disk_wms(tmp_path):
+    output = tmp_path / 'output'
+    mbtiles_to_disk(str(ONE_TILE), str(output), scheme='wms')
+    assert (output / '00/000/000/000/000/000/000.png').exists()
+    assert (output / '01/000/000/000/000/000/001.png').exists()
+
+def test_grid_body_without_grid_data():
+    stored = zlib.compress(json.dumps({'grid': [' !'], 'keys': ['', '1']}).encode())
+    assert json.loads(grid_body(stored, {})) == {'grid': [' !'], 'keys': ['', '1'], 'data': {}}
+    assert grid_body(stored, {}, 'foo').startswith(b'foo({')
+
+def test_iter_grids_schema_errors():
+    con = sqlite3.connect(':memory:')
+    assert list(iter_grids(con)) == []  # no grids table: nothing to export
+    con.execute('create table grids (zoom_level integer, tile_column integer, tile_row integer, grid blob)')
+    with pytest.raises(sqlite3.OperationalError):
+        list(iter_grids(con))  # grids without grid_data is a broken file
+    con.close()
+
+@pytest.mark.parametrize("stored", [b'{}', b'{ }\n'])
+def test_grid_body_empty_grid(stored):
+    assert json.loads(grid_body(zlib.compress(stored), {})) == {'data': {}}
+
+def test_grid_body_with_inline_data():
+    stored = zlib.compress(b'{"grid": [" "], "keys": [""], "data": {"1": {"a": 1}}}')
+    body = grid_body(stored, {})
+    assert body.count(b'"data"') == 1
+    assert json.loads(body) == {'grid': [' '], 'keys': [''], 'data': {}}
+
+def test_disk_to_mbtiles_zyx(tmp_path, memory_mbtiles):
+    output = tmp_path / 'output'
+    disk_to_mbtiles(str(ZYX), memory_mbtiles, scheme='zyx', format='png')
+    mbtiles_to_disk(memory_mbtiles, str(output), callback=None)
+    assert (output / '3/1/5.png').exists()
+
+def test_disk_to_mbtiles_compression(tmp_path, decoded_one_tile):
+    output = tmp_path / 'output'
+    output.mkdir(parents=True, exist_ok=True)
+    clone_tree(decoded_one_tile, output / 'original')
+    # a second copy of an existing tile must share its image row
+    shutil.copy(str(output / 'original/0/0/0.png'), str(output / 'original/1/0/0.png'))
+    disk_to_mbtiles(str(output / 'original'), str(output / 'compressed.mbtiles'), format='png', compression=True)
+    con = sqlite3.connect(str(output / 'compressed.mbtiles'))
+    assert con.execute('select count(*) from map').fetchone()[0] == 3
+    assert con.execute('select count(*) from images').fetchone()[0] == 2
+    con.close()
+    mbtiles_to_disk(str(output / 'compressed.mbtiles'), str(output / 'exported'))
+    assert (output / 'exported/1/0/0.png').exists()
+
+def test_disk_to_mbtiles_compression_hash_collision(tmp_path, decoded_one_tile, monkeypatch):
+    # every tile gets the same digest; only identical bytes may be merged
+    monkeypatch.setattr(mbutil.util, '_tile_hash', lambda tile_data: b'same')
+    output = tmp_path / 'output'
+    output.mkdir(parents=True, exist_ok=True)
+    clone_tree(decoded_one_tile, output / 'original')
+    disk_to_mbtiles(str(output / 'original'), str(output / 'compressed.mbtiles'), format='png', compression=True)
+    con = sqlite3.connect(str(output / 'compressed.mbtiles'))
+    distinct = con.execute('select count(distinct tile_data) from tiles').fetchone()[0]
+    assert con.execute('select count(*) from images').fetchone()[0] == distinct
+    assert con.execute('select count(*) from map').fetchone()[0] == 2
+    con.close()
+    exported = output / 'exported'
+    mbtiles_to_disk(str(output / 'compressed.mbtiles'), str(exported))
+    for png in ('0/0/0.png', '1/0/1.png'):
+        assert (exported / png).read_bytes() == (decoded_one_tile / png).read_bytes()
+
+def test_mbtiles_to_s3_uploads_objects(s3_client, bucket):
     mbtiles_to_s3(
-        mbtiles, BUCKET,
+        str(ONE_TILE), bucket,
         prefix="tiles",
         scheme="xyz",
         format="png",
@@ -85,13 +219,84 @@ def test_mbtiles_to_s3_uploads_objects():
         content_encoding="gzip",
     )
 
-    meta = s3.get_object(Bucket=BUCKET, Key="tiles/metadata.json")
-    assert meta["ContentType"].startswith("application/json")
+    pages = s3_client.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix="tiles/")
+    keys = {o["Key"] for page in pages for o in page["Contents"]}
+    assert "tiles/metadata.json" in keys
+    assert "tiles/0/0/0.png" in keys
+
+    # boto3 clients are safe to share between threads
+    tile_keys = sorted(k for k in keys if k.endswith(".png"))
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        heads = list(executor.map(lambda k: s3_client.head_object(Bucket=bucket, Key=k), tile_keys))
+    for head in heads:
+        assert head["ContentType"] == "image/png"
+        assert head["CacheControl"] == "max-age=60"
+        assert head["ContentLength"] > 0
+
+def test_mbtiles_to_s3_uploads_grids(s3_client, bucket):
+    mbtiles_to_s3(str(UTF8GRID), bucket, prefix="grids", callback=None)
+
+    grid = json.loads(s3_client.get_object(Bucket=bucket, Key="grids/0/0/0.grid.json")["Body"].read())
+    assert grid['data']['77'] == {'ISO_A2': 'FR'}
+
+@pytest.fixture
+def run_main(monkeypatch):
+    """Call mbutil.cli.main(argv) and return its exit code, leaving the
+    process-wide logging configuration alone."""
+    monkeypatch.setattr(mbutil.cli, 'configure_logging', lambda **kwargs: None)
+
+    def run(*argv):
+        with pytest.raises(SystemExit) as exc:
+            mbutil.cli.main([str(arg) for arg in argv])
+        return exc.value.code
+    return run
+
+@pytest.fixture
+def cli_paths(tmp_path):
+    """One path per kind mbutil.cli._classify (or the output lookup) knows."""
+    existing = tmp_path / 'existing.mbtiles'
+    existing.write_bytes(b'')
+    return {
+        'file': ONE_TILE,
+        'dir': ZYX,
+        'missing': tmp_path / 'missing',
+        'other': os.devnull,
+        's3': 's3://bucket',
+        'dumps': 'dumps',
+        'existing_file': existing,
+        'existing_dir': tmp_path,
+    }
+
+def _cli_dst(cli_paths, kind):
+    return cli_paths.get('existing_' + kind, cli_paths[kind])
+
+@pytest.mark.parametrize("kinds", sorted(mbutil.cli._HANDLERS))
+def test_cli_dispatches_handlers(run_main, cli_paths, monkeypatch, kinds):
+    calls = []
+    monkeypatch.setitem(mbutil.cli._HANDLERS, kinds, lambda src, dst, options, executor: calls.append((src, dst)))
+    src, dst = cli_paths[kinds[0]], _cli_dst(cli_paths, kinds[1])
+    assert run_main(src, dst) == 0
+    assert calls == [(str(src), str(dst))]
+
+@pytest.mark.parametrize("kinds", sorted(mbutil.cli._ERRORS))
+def test_cli_rejects_invalid_pairs(run_main, cli_paths, capsys, kinds):
+    src, dst = cli_paths[kinds[0]], _cli_dst(cli_paths, kinds[1])
+    assert run_main(src, dst) == 1
+    assert capsys.readouterr().err == mbutil.cli._ERRORS[kinds]
+
+def test_cli_dumps_exits_zero(run_main):
+    assert run_main(ONE_TILE, 'dumps', '--silent') == 0
+
+def test_cli_missing_input(run_main, tmp_path, capsys):
+    assert run_main(tmp_path / 'nope.mbtiles', tmp_path / 'out') == 1
+    assert 'does not exist' in capsys.readouterr().err
 
-    head = s3.head_object(Bucket=BUCKET, Key="tiles/0/0/0.png")
-    assert head["ContentType"] == "image/png"
-    assert head["CacheControl"] == "max-age=60"
+def test_cli_rejects_zero_max_workers(run_main, tmp_path, capsys):
+    assert run_main(ONE_TILE, tmp_path / 'out', '--max_workers', '0') == 2
+    assert 'not a positive integer' in capsys.readouterr().err
+    assert not (tmp_path / 'out').exists()
 
-    body = s3.get_object(Bucket=BUCKET, Key="tiles/0/0/0.png")["Body"].read()
-    assert isinstance(body, (bytes, bytearray))
-    assert len(body) > 0
+@pytest.mark.parametrize("argv,code", [(['-h'], 0), (['--help'], 0), ([], 1), ([ONE_TILE], 1)])
+def test_cli_help(run_main, capsys, argv, code):
+    assert run_main(*argv) == code
+    assert capsys.readouterr().out.startswith('usage: mb-util')